@@ -2,7 +2,6 @@ import json
 import argparse
 from typing import Dict, Any
 
-import duckdb
 import numpy as np
 import polars as pl
 from tqdm import tqdm
@@ -14,6 +13,7 @@ from openai import OpenAI
 from src.config import get_config
 from src.agent_tools import AgentTools
 from src.cinema_expert import CinemaExpert
+from src.datastore import DatastoreSnapshot
 from src.models import CinemaExpertRequest
 
 logger = get_logger("performance-assessment")
@@ -51,7 +51,7 @@ def run_domain_knowledge_test(expert: CinemaExpert, test: Dict[str, Any]) -> flo
     return n_correct / len(test["questions"])
 
 
-def sample_users(n_users: int, database_path: str) -> pl.DataFrame:
+def sample_users(n_users: int, snapshot: DatastoreSnapshot) -> pl.DataFrame:
     sql = f"""
     WITH user_review_counts AS (
         SELECT userId
@@ -93,12 +93,12 @@ def sample_users(n_users: int, database_path: str) -> pl.DataFrame:
     GROUP BY h.userId, h.holdout_movie_id, h.holdout_rating, h.holdout_title
     """
 
-    with duckdb.connect(database_path) as conn:
+    with snapshot.cursor() as conn:
         return conn.sql(sql).pl()
 
 
 def run_embedding_recommendation_test(
-    expert: CinemaExpert, users: pl.DataFrame, database_path: str
+    expert: CinemaExpert, users: pl.DataFrame
 ) -> Dict[str, float]:
     user_embeddings = []
     holdout_embeddings = []
@@ -108,7 +108,7 @@ def run_embedding_recommendation_test(
         user_prompt = f"I love {user['liked_movies_excluding_holdout']}. What should I watch tonight?"
         user_embeddings.append(expert.tools.model.encode(user_prompt))
 
-        with duckdb.connect(database_path) as conn:
+        with expert.tools.current_snapshot().cursor() as conn:
             emb = conn.execute(
                 "SELECT embedding FROM movie WHERE movieId = ?",
                 [user["holdout_movie_id"]],
@@ -165,11 +165,11 @@ def main():
     parser.add_argument("--all", action="store_true")
     parser.add_argument("--output", default="run_results.json")
     parser.add_argument("--n-users", type=int, default=100)
-    parser.add_argument("--db-path", default="data/cinemastore")
     parser.add_argument("--calicut-path", default="data/unv_calicult_eng410.json")
     args = parser.parse_args()
 
     expert = startup_application()
+    expert.tools.collect_output_token_stats = True
     results = {}
 
     if args.domain_test or args.all:
@@ -179,10 +179,10 @@ def main():
         logger.info("DomainKnowledgeComplete", score=score)
 
     if args.recommendation_test or args.taste_test or args.all:
-        users = sample_users(args.n_users, args.db_path)
+        users = sample_users(args.n_users, expert.tools.current_snapshot())
 
     if args.recommendation_test or args.all:
-        rec_results = run_embedding_recommendation_test(expert, users, args.db_path)
+        rec_results = run_embedding_recommendation_test(expert, users)
         results["embedding_recommendation"] = rec_results
         logger.info("RecommendationEvalComplete", **rec_results)
 
@@ -191,6 +191,9 @@ def main():
         results["taste_classification_accuracy"] = score
         logger.info("TasteClassificationComplete", score=score)
 
+    results["tool_output_tokens"] = expert.tools.output_token_stats
+    logger.info("ToolOutputTokens", **expert.tools.output_token_stats)
+
     with open(args.output, "w") as f:
         json.dump(results, f, indent=2)
 
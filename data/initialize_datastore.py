@@ -1,7 +1,11 @@
 import argparse
+import glob
+import re
+from datetime import datetime
 from typing import Tuple
 
 import duckdb
+import numpy as np
 import polars as pl
 from sentence_transformers import SentenceTransformer
 from structlog import get_logger
@@ -12,6 +16,16 @@ load_dotenv()
 
 embedding_model_id = os.getenv("EMBEDDING_MODEL")
 DB_PATH = os.getenv("DB_PATH")
+SNAPSHOT_RETENTION = int(os.getenv("SNAPSHOT_RETENTION", 3))
+NEIGHBOR_K = int(os.getenv("NEIGHBOR_K", 50))
+NEIGHBOR_BLOCK_SIZE = int(os.getenv("NEIGHBOR_BLOCK_SIZE", 1024))
+
+# these mirror the filters get_movie_recommendation applies at request time,
+# so a neighbour list never contains a movie the search would have excluded.
+NEIGHBOR_TIERS = {
+    "high": (float(os.getenv("MOVIE_SEARCH_MIN_BAYESIAN_AVG_HIGH")), 50),
+    "low": (float(os.getenv("MOVIE_SEARCH_MIN_BAYESIAN_AVG_LOW")), 1),
+}
 
 logger = get_logger("data-ingest")
 
@@ -87,6 +101,105 @@ def bayesian_average(
     return df.with_columns(bayesian_avg=bayesian_avg_expr)
 
 
+def add_search_title(df: pl.DataFrame) -> pl.DataFrame:
+    """MovieLens titles look like 'Matrix, The (1999)'. Users type 'The Matrix',
+    so store a normalized version to resolve seed titles against. This has to
+    stay in sync with normalize_title in src/agent_tools.py."""
+    search_title = (
+        pl.col("title")
+        .str.to_lowercase()
+        .str.replace_all(r"\s*\([^)]*\)", "")
+        .str.strip_chars()
+        .str.replace(r"^(.*), (the|a|an)$", "${2} ${1}")
+    )
+    return df.with_columns(search_title=search_title)
+
+
+def compute_neighbors(
+    df: pl.DataFrame, k: int = NEIGHBOR_K, block_size: int = NEIGHBOR_BLOCK_SIZE
+) -> pl.DataFrame:
+    """Precompute the top k most similar movies for every movie, once per
+    tier. The full similarity matrix for the catalogue does not fit in memory,
+    so seeds are processed in blocks of rows against the tier's candidates.
+    Every movie gets a neighbour list (a user can love something obscure), but
+    only movies passing the tier filter are allowed as neighbours."""
+    movie_ids = df["movieId"].to_numpy()
+    titles = np.array(df["title"].to_list())
+    # astype copies, the normalization below needs a writable array
+    embeddings = df["embedding"].to_numpy().astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    frames = []
+    for tier, (min_bayesian_avg, min_n_rating) in NEIGHBOR_TIERS.items():
+        mask = (
+            (df["bayesian_avg"] >= min_bayesian_avg) & (df["n_rating"] >= min_n_rating)
+        ).to_numpy()
+        candidates = embeddings[mask]
+        candidate_ids = movie_ids[mask]
+        candidate_titles = titles[mask]
+        # position of each movie in the candidate matrix, -1 if filtered out.
+        # used to stop a movie from being its own neighbour.
+        candidate_index = np.full(len(movie_ids), -1)
+        candidate_index[mask] = np.arange(mask.sum())
+        top_k = min(k, len(candidate_ids))
+        if top_k == 0:
+            continue
+
+        for start in range(0, len(movie_ids), block_size):
+            stop = min(start + block_size, len(movie_ids))
+            similarity = embeddings[start:stop] @ candidates.T
+            rows = np.arange(stop - start)
+            self_index = candidate_index[start:stop]
+            is_candidate = self_index >= 0
+            similarity[rows[is_candidate], self_index[is_candidate]] = -np.inf
+
+            top = np.argpartition(-similarity, top_k - 1, axis=1)[:, :top_k]
+            top_similarity = np.take_along_axis(similarity, top, axis=1)
+            order = np.argsort(-top_similarity, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_similarity = np.take_along_axis(top_similarity, order, axis=1)
+
+            block = pl.DataFrame(
+                {
+                    "movieId": np.repeat(movie_ids[start:stop], top_k),
+                    "rank": np.tile(np.arange(1, top_k + 1), stop - start),
+                    "neighborId": candidate_ids[top.ravel()],
+                    # stored here so a lookup never has to join back to movie
+                    "neighborTitle": candidate_titles[top.ravel()],
+                    "similarity": top_similarity.ravel(),
+                }
+            )
+            block = block.with_columns(tier=pl.lit(tier))
+            frames.append(block.filter(pl.col("similarity").is_finite()))
+        logger.info("ComputedNeighbors", tier=tier, n_candidates=len(candidate_ids))
+
+    return pl.concat(frames)
+
+
+def publish_snapshot(db_name: str, snapshot_path: str):
+    """Point the running server at a freshly written snapshot. The pointer is
+    replaced atomically so readers see either the old name or the new one.
+    This has to stay in sync with resolve_snapshot_path in src/datastore.py."""
+    pointer = f"{db_name}.current"
+    tmp_pointer = f"{pointer}.tmp"
+    with open(tmp_pointer, "w") as f:
+        f.write(os.path.basename(snapshot_path))
+    os.replace(tmp_pointer, pointer)
+
+
+def prune_snapshots(db_name: str, keep: int = SNAPSHOT_RETENTION):
+    # the previous snapshots are kept around so requests that started before
+    # a swap can finish, and so a bad refresh can be rolled back by hand.
+    snapshots = sorted(
+        path for path in glob.glob(f"{db_name}-*") if re.search(r"-\d{8}T\d{6}$", path)
+    )
+    for path in snapshots[:-keep]:
+        for stale in (path, f"{path}.wal"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        logger.info("PrunedSnapshot", path=path)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Process movie data and create a database."
@@ -129,15 +242,26 @@ def main():
         .sort("n_rating")
     )
     movies_with_metadata = bayesian_average(movies_with_metadata)
+    movies_with_metadata = add_search_title(movies_with_metadata)
+    movie_neighbors = compute_neighbors(movies_with_metadata)
 
-    conn = duckdb.connect(db_name)
+    # never write to the file the server is reading. Each run gets its own
+    # snapshot which is published once it is complete.
+    snapshot_path = f"{db_name}-{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    conn = duckdb.connect(snapshot_path)
 
     conn.sql("install vss")
     # here i used create or replace to make sure this process is idempotent
     conn.sql("create or replace Table movie as select * from movies_with_metadata")
     conn.sql("create or replace Table user as select * from rating_df")
+    conn.sql("create index movie_search_title on movie (search_title)")
+    # sorted so a lookup for a few seeds only reads the row groups holding them
+    conn.sql("""create or replace Table movie_neighbors as
+        select * from movie_neighbors order by tier, movieId""")
     conn.close()
-    logger.info("DataIngested")
+    publish_snapshot(db_name, snapshot_path)
+    prune_snapshots(db_name)
+    logger.info("DataIngested", snapshot=snapshot_path)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,26 @@
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.routing import Route
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 from pydantic import ValidationError
 from uuid import UUID
+from typing import Any, AsyncIterator, Dict, List, Union
+import asyncio
 import json
 from src.cinema_expert import CinemaExpert
-from src.models import CinemaExpertRequest
+from src.models import CinemaExpertRequest, CinemaExpertResponse
 from src.config import get_config
 from src.agent_tools import AgentTools
+from src.admission import AdmissionController, AdmissionRejected
+from src.deadline import Deadline, DeadlineExceeded, RequestCancelled
 from openai import OpenAI
 
+# how often a running request checks whether its client is still there
+DISCONNECT_POLL_S = 0.5
+
 
 def startup_application() -> CinemaExpert:
     config = get_config()
@@ -22,22 +30,105 @@ def startup_application() -> CinemaExpert:
 
 
 expert = startup_application()
+admission = AdmissionController(
+    max_in_flight=expert.config.max_in_flight,
+    max_queue=expert.config.max_queue,
+    queue_timeout_s=expert.config.queue_timeout_s,
+    retry_after_s=expert.config.retry_after_s,
+)
+
+
+def serialize_response(response: CinemaExpertResponse) -> Dict[str, Any]:
+    response_dict = response.model_dump()
+
+    for key, value in response_dict.items():
+        if isinstance(value, UUID):
+            response_dict[key] = str(value)
+
+    return response_dict
+
+
+async def iter_ndjson(request: Request) -> AsyncIterator[bytes]:
+    # yield each line as soon as it has arrived instead of buffering the body
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+def parse_batch_item(
+    index: int, raw: Any
+) -> Union[CinemaExpertRequest, Dict[str, Any]]:
+    """Validate one batch item. A bad item becomes an error record for the
+    output stream rather than failing the whole batch."""
+    if isinstance(raw, bytes):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            return {"index": index, "error": "Invalid JSON format"}
+    try:
+        return CinemaExpertRequest.model_validate(raw)
+    except ValidationError as e:
+        record = {"index": index, "error": "Invalid request format", "details": str(e)}
+        if isinstance(raw, dict) and "request_id" in raw:
+            record["request_id"] = str(raw["request_id"])
+        return record
+
+
+async def invoke_until_disconnected(
+    request: Request, expert_request: CinemaExpertRequest, deadline: Deadline
+) -> CinemaExpertResponse:
+    work = asyncio.ensure_future(
+        run_in_threadpool(expert.invoke, expert_request, deadline=deadline)
+    )
+    while True:
+        done, _ = await asyncio.wait({work}, timeout=DISCONNECT_POLL_S)
+        if done:
+            return work.result()
+        if await request.is_disconnected():
+            deadline.cancel()
+            # the worker thread keeps its admission slot until it notices the
+            # cancellation, since it is still using real capacity until then.
+            await asyncio.gather(work, return_exceptions=True)
+            raise RequestCancelled("The client disconnected")
+
+
+def overloaded_response(e: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        {"error": "Server overloaded", "details": str(e)},
+        status_code=503,
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
 
 async def cinema_expert_endpoint(request: Request):
+    deadline = Deadline(expert.config.request_deadline_s)
     try:
         body = await request.json()
         expert_request = CinemaExpertRequest(**body)
 
-        response = expert.invoke(expert_request)
-
-        response_dict = response.model_dump()
-
-        for key, value in response_dict.items():
-            if isinstance(value, UUID):
-                response_dict[key] = str(value)
+        async with admission.admit(deadline):
+            response = await invoke_until_disconnected(
+                request, expert_request, deadline
+            )
 
-        return JSONResponse(response_dict)
+        return JSONResponse(serialize_response(response))
+    except AdmissionRejected as e:
+        return overloaded_response(e)
+    except DeadlineExceeded as e:
+        return JSONResponse(
+            {"error": "Deadline exceeded", "details": str(e)}, status_code=504
+        )
+    except RequestCancelled as e:
+        # nobody is listening, but uvicorn still wants a response
+        return JSONResponse(
+            {"error": "Client disconnected", "details": str(e)}, status_code=499
+        )
     except ValidationError as e:
         return JSONResponse(
             {"error": "Invalid request format", "details": str(e)}, status_code=422
@@ -50,6 +141,92 @@ async def cinema_expert_endpoint(request: Request):
         )
 
 
+async def cinema_expert_batch_endpoint(request: Request):
+    semaphore = asyncio.Semaphore(expert.config.batch_max_concurrency)
+    deadlines: List[Deadline] = []
+    results: asyncio.Queue = asyncio.Queue()
+    tasks: List[asyncio.Future] = []
+
+    async def run_one(index: int, raw: Any):
+        expert_request = parse_batch_item(index, raw)
+        if isinstance(expert_request, dict):
+            await results.put(expert_request)
+            return
+        async with semaphore:
+            result: Dict[str, Any] = {
+                "index": index,
+                "request_id": str(expert_request.request_id),
+            }
+            # each item gets its own deadline from when it is allowed to start,
+            # otherwise the tail of a large batch would always time out.
+            deadline = Deadline(expert.config.request_deadline_s)
+            deadlines.append(deadline)
+            try:
+                async with admission.admit(deadline, wait_for_slot=True):
+                    response = await run_in_threadpool(
+                        expert.invoke, expert_request, deadline=deadline
+                    )
+                result["response"] = serialize_response(response)
+            except DeadlineExceeded as e:
+                result["error"] = "Deadline exceeded"
+                result["details"] = str(e)
+            except Exception as e:
+                # one bad item should not take down the rest of the batch
+                result["error"] = "Internal server error"
+                result["details"] = str(e)
+            await results.put(result)
+
+    def start(index: int, raw: Any):
+        tasks.append(asyncio.ensure_future(run_one(index, raw)))
+
+    # accept either a json array of requests or one request per line (ndjson).
+    # ndjson items start as soon as their line arrives. The body is still read
+    # to the end before the response starts, since reading the request while
+    # streaming the response would race starlette's disconnect listener.
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        index = 0
+        try:
+            async for line in iter_ndjson(request):
+                start(index, line)
+                index += 1
+        except Exception:
+            # the client went away mid-upload, stop what already started
+            for task in tasks:
+                task.cancel()
+            for deadline in deadlines:
+                deadline.cancel()
+            raise
+    else:
+        try:
+            items = await request.json()
+        except json.JSONDecodeError:
+            return JSONResponse({"error": "Invalid JSON format"}, status_code=400)
+        if not isinstance(items, list):
+            return JSONResponse(
+                {
+                    "error": "Invalid request format",
+                    "details": "Batch body must be a list of requests",
+                },
+                status_code=422,
+            )
+        for index, item in enumerate(items):
+            start(index, item)
+
+    async def stream_results():
+        try:
+            for _ in range(len(tasks)):
+                result = await results.get()
+                yield json.dumps(result) + "\n"
+        finally:
+            # runs when the client goes away mid-stream as well
+            for task in tasks:
+                task.cancel()
+            for deadline in deadlines:
+                deadline.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 async def health_check(request: Request):
     return JSONResponse({"status": "healthy"})
 
@@ -63,6 +240,7 @@ middleware = [
 app = Starlette(
     routes=[
         Route("/cinema-expert", cinema_expert_endpoint, methods=["POST"]),
+        Route("/cinema-expert/batch", cinema_expert_batch_endpoint, methods=["POST"]),
         Route("/health", health_check, methods=["GET"]),
     ],
     middleware=middleware,
@@ -0,0 +1,68 @@
+# when the llm slows down, accepting every request just grows a queue until
+# everything times out together. This caps how many requests run at once and
+# how many may wait for a slot. Anything that can't start in time is turned
+# away straight away so the client can retry somewhere else.
+import asyncio
+from contextlib import asynccontextmanager
+
+from structlog import get_logger
+
+from .deadline import Deadline, DeadlineExceeded
+
+logger = get_logger("admission")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("The server is at capacity")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int,
+        queue_timeout_s: float,
+        retry_after_s: int,
+    ):
+        self.max_queue = max_queue
+        self.queue_timeout_s = queue_timeout_s
+        self.retry_after_s = retry_after_s
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._waiting = 0
+
+    @asynccontextmanager
+    async def admit(self, deadline: Deadline, wait_for_slot: bool = False):
+        """Hold one in-flight slot for the duration of the block. Interactive
+        requests fail fast when the queue is full or they can't start within
+        the queue timeout. With wait_for_slot (batch items, which are already
+        throttled by their batch) the caller waits up to its own deadline and
+        doesn't count against the interactive queue."""
+        if wait_for_slot:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Timed out waiting for a free slot")
+        else:
+            await self._acquire_or_reject(deadline)
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    async def _acquire_or_reject(self, deadline: Deadline):
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            logger.info("RequestRejected", reason="queue_full")
+            raise AdmissionRejected(self.retry_after_s)
+
+        self._waiting += 1
+        try:
+            timeout = min(self.queue_timeout_s, deadline.remaining())
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            logger.info("RequestRejected", reason="queue_timeout")
+            raise AdmissionRejected(self.retry_after_s)
+        finally:
+            self._waiting -= 1
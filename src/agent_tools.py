@@ -1,12 +1,22 @@
 # my decision to seperate this out is to allow for tool usage to be
 # decoupled from the rest of the application. I can add new tools
 # without breaking my contract
+import inspect
 import json
-from typing import Dict, List, Any
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional
 from .config import Config
 import tmdbsimple as tmdb
 import duckdb
+import requests
 from sentence_transformers import SentenceTransformer
+from .embedding_batcher import EmbeddingBatcher
+from .single_flight import SingleFlight, normalize_arguments
+from .deadline import Deadline, DeadlineExceeded, remaining_or_none
+from .projection import estimate_tokens, project_tool_output
+from .datastore import DatastoreSnapshot, SnapshotManager, resolve_snapshot_path
 from structlog import get_logger
 import os
 
@@ -41,6 +51,22 @@ TOOLS = [
             "required": ["movie"],
         },
     },
+    {
+        "type": "function",
+        "name": "get_similar_movies",
+        "description": """Get films similar to one or more movies the user
+        already likes. Only pass the names of the movies. For example:
+        ['The Matrix', 'Blade Runner']""",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "titles": {"type": "array", "items": {"type": "string"}},
+                "k": {"type": "integer"},
+                "user_desires_critically_acclaimed": {"type": "boolean"},
+            },
+            "required": ["titles"],
+        },
+    },
     {
         "type": "web_search",
         "filters": {
@@ -56,25 +82,89 @@ TOOLS = [
 ]
 
 
+# how close a fuzzy title match has to be before we trust it as a seed
+TITLE_MATCH_THRESHOLD = 0.85
+
+
+def normalize_title(title: str) -> str:
+    # must stay in sync with add_search_title in data/initialize_datastore.py
+    title = re.sub(r"\s*\([^)]*\)", "", title.lower()).strip()
+    return re.sub(r"^(.*), (the|a|an)$", r"\2 \1", title)
+
+
+@contextmanager
+def interrupt_at_deadline(conn, deadline: Optional[Deadline]):
+    # duckdb queries can't take a timeout, but a connection can be interrupted
+    # from another thread.
+    if deadline is None:
+        yield
+        return
+    deadline.check()
+    timer = threading.Timer(deadline.remaining(), conn.interrupt)
+    timer.start()
+    try:
+        yield
+    except duckdb.InterruptException:
+        raise DeadlineExceeded("Datastore query ran past the request deadline")
+    finally:
+        timer.cancel()
+
+
 class AgentTools:
     def __init__(self, config: Config):
-        if not os.path.exists(config.db_path):
+        if not os.path.exists(resolve_snapshot_path(config.db_path)):
             raise FileNotFoundError("""The database does not exist.
                                     Please run make install before running this
                                     server""")
         self.tools = TOOLS
+        self.datastore = SnapshotManager(config.db_path, config.snapshot_poll_s)
         self.config = config
         self.model = SentenceTransformer(config.embedding_model)
+        self.embedder = EmbeddingBatcher(
+            self.model,
+            max_batch_size=config.embedding_batch_size,
+            max_wait_ms=config.embedding_batch_wait_ms,
+        )
         tmdb.API_KEY = config.tmdb_api_key
+        self.single_flight = SingleFlight()
+        # approximate tokens each tool would have sent to the llm before and
+        # after projection. Measuring means serializing the raw payload again,
+        # so it is off unless assess_performance.py turns it on.
+        self.collect_output_token_stats = False
+        self.output_token_stats: Dict[str, Dict[str, int]] = {}
+        self._stats_lock = threading.Lock()
+        # tool name -> (implementation, key the result is wrapped in)
+        self.handlers = {
+            "get_movie_recommendation": (
+                self._get_movie_recommendation,
+                "movie_recommendation",
+            ),
+            "get_movie_information": (
+                self._get_movie_information,
+                "movie_information",
+            ),
+            "get_similar_movies": (self._get_similar_movies, "similar_movies"),
+        }
 
     def get_tools(self):
         # TODO: make web filters configurable without changing code
         return self.tools
 
-    def _search(self, query, bayesian_avg, n_rating, k=10):
-        embedding = self.model.encode(query)
+    def current_snapshot(self) -> DatastoreSnapshot:
+        return self.datastore.current
+
+    def _search(
+        self, query, bayesian_avg, n_rating, k=10, deadline=None, snapshot=None
+    ):
+        snapshot = snapshot or self.current_snapshot()
+        if deadline is not None:
+            deadline.check()
+        try:
+            embedding = self.embedder.encode(query, timeout=remaining_or_none(deadline))
+        except TimeoutError:
+            raise DeadlineExceeded("Timed out waiting on the query embedding")
         embedding = [[float(x) for x in embedding]]
-        with duckdb.connect(self.config.db_path) as conn:
+        with snapshot.cursor() as conn, interrupt_at_deadline(conn, deadline):
             out = conn.execute(
                 f"""
                 SELECT
@@ -97,7 +187,12 @@ class AgentTools:
         return movie_recs
 
     def _get_movie_recommendation(
-        self, user_request: str, k=10, user_desires_critically_acclaimed=False
+        self,
+        user_request: str,
+        k=10,
+        user_desires_critically_acclaimed=False,
+        deadline: Optional[Deadline] = None,
+        snapshot: Optional[DatastoreSnapshot] = None,
     ) -> List[str]:
         # this is a place where the code and method could improve. I am leaving
         # the decision up to the llm on if the use wants a well known
@@ -107,54 +202,195 @@ class AgentTools:
         # TODO: make these values configurable
         if user_desires_critically_acclaimed:
             return self._search(
-                user_request, self.config.movie_search_cutoff_high, 50, k
+                user_request,
+                self.config.movie_search_cutoff_high,
+                50,
+                k,
+                deadline,
+                snapshot,
             )
         else:
-            return self._search(user_request, self.config.movie_search_cutoff_low, 1, k)
+            return self._search(
+                user_request,
+                self.config.movie_search_cutoff_low,
+                1,
+                k,
+                deadline,
+                snapshot,
+            )
 
-    def _get_movie_information(self, movie: str, n_results=3) -> Dict[str, Any]:
+    def _resolve_titles(self, conn, titles: List[str]) -> List[Dict[str, Any]]:
+        seeds = []
+        for title in titles:
+            search_title = normalize_title(title)
+            # the exact match is an index lookup. Only misspelled titles pay
+            # for the fuzzy scan over the whole catalogue.
+            row = conn.execute(
+                """
+                SELECT movieId, title
+                FROM movie
+                WHERE search_title = ?
+                ORDER BY n_rating DESC
+                LIMIT 1
+                """,
+                [search_title],
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    """
+                    SELECT movieId, title
+                    FROM (
+                        SELECT
+                            movieId,
+                            title,
+                            n_rating,
+                            jaro_winkler_similarity(search_title, ?) AS score
+                        FROM movie
+                    )
+                    WHERE score >= ?
+                    ORDER BY score DESC, n_rating DESC
+                    LIMIT 1
+                    """,
+                    [search_title, TITLE_MATCH_THRESHOLD],
+                ).fetchone()
+            if row is None:
+                logger.info("TitleNotResolved", title=title)
+                continue
+            seeds.append({"movieId": row[0], "title": row[1]})
+        return seeds
+
+    def _get_similar_movies(
+        self,
+        titles: List[str],
+        k=10,
+        user_desires_critically_acclaimed=False,
+        deadline: Optional[Deadline] = None,
+        snapshot: Optional[DatastoreSnapshot] = None,
+    ) -> Dict[str, Any]:
+        # neighbours are precomputed per tier at ingestion time, so this is a
+        # lookup and merge rather than an embedding plus a full scan. Movies
+        # close to several of the seeds float to the top.
+        tier = "high" if user_desires_critically_acclaimed else "low"
+        snapshot = snapshot or self.current_snapshot()
+        with snapshot.cursor() as conn, interrupt_at_deadline(conn, deadline):
+            seeds = self._resolve_titles(conn, titles)
+            seed_ids = [seed["movieId"] for seed in seeds]
+            if not seed_ids:
+                return {"resolved_titles": [], "similar_movies": []}
+            # plain IN lists (rather than list_contains) so the seed filter is
+            # pushed down to the sorted table's zone maps
+            placeholders = ", ".join("?" for _ in seed_ids)
+            out = conn.execute(
+                f"""
+                SELECT
+                    neighborTitle,
+                    SUM(similarity) AS score
+                FROM movie_neighbors
+                WHERE
+                    tier = ? AND
+                    movieId IN ({placeholders}) AND
+                    neighborId NOT IN ({placeholders})
+                GROUP BY neighborTitle
+                ORDER BY score DESC
+                LIMIT {int(k)}
+                """,
+                [tier, *seed_ids, *seed_ids],
+            ).fetchall()
+        similar_movies = [x[0] for x in out]
+        logger.info("MadeNeighborLookup", seeds=seeds, returned_movies=similar_movies)
+        return {
+            "resolved_titles": [seed["title"] for seed in seeds],
+            "similar_movies": similar_movies,
+        }
+
+    def _tmdb_call(self, obj, method: str, deadline: Optional[Deadline], **kwargs):
+        # tmdbsimple reads the requests timeout off the object, so each call
+        # only gets whatever is left of the request's deadline.
+        if deadline is not None:
+            deadline.check()
+            obj.timeout = deadline.remaining()
+        try:
+            return getattr(obj, method)(**kwargs)
+        except requests.exceptions.Timeout:
+            raise DeadlineExceeded("TMDB call ran past the request deadline")
+
+    def _get_movie_information(
+        self, movie: str, n_results=3, deadline: Optional[Deadline] = None
+    ) -> Dict[str, Any]:
         out = []
         try:
             search = tmdb.Search()
-            result = search.movie(query=movie)
+            result = self._tmdb_call(search, "movie", deadline, query=movie)
             ids = [result["results"][x]["id"] for x in range(n_results)]
             for id in ids:
                 movie_info = {}
                 movie_obj = tmdb.Movies(id)
-                movie_info["info"] = movie_obj.info()
-                movie_info["credits"] = movie_obj.credits()
+                movie_info["info"] = self._tmdb_call(movie_obj, "info", deadline)
+                movie_info["credits"] = self._tmdb_call(movie_obj, "credits", deadline)
                 out.append(movie_info)
             logger.info("CompletedMovieSearch", movie=movie)
         except IndexError:
             logger.info("MovieSearchFailed", movie=movie)
         return out
 
-    def handle_tool_calls(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def _record_output_tokens(self, name: str, raw_output: str, tool_output: str):
+        with self._stats_lock:
+            stats = self.output_token_stats.setdefault(
+                name, {"calls": 0, "raw_tokens": 0, "projected_tokens": 0}
+            )
+            stats["calls"] += 1
+            stats["raw_tokens"] += estimate_tokens(raw_output)
+            stats["projected_tokens"] += estimate_tokens(tool_output)
+
+    def _call_tool(
+        self,
+        name: str,
+        arguments: Dict[str, Any],
+        deadline: Optional[Deadline],
+        snapshot: Optional[DatastoreSnapshot],
+    ) -> Any:
+        handler, _ = self.handlers[name]
+        signature = inspect.signature(handler)
+        # fill in defaults so {"movie": "x"} and {"movie": "x", "n_results": 3}
+        # share a key.
+        bound = signature.bind(**arguments)
+        bound.apply_defaults()
+        bound.arguments.pop("deadline")
+        bound.arguments.pop("snapshot", None)
+        key = (name, normalize_arguments(bound.arguments))
+        if "snapshot" in signature.parameters:
+            # calls against different datastore versions must not coalesce
+            snapshot = snapshot or self.current_snapshot()
+            key += (snapshot.path,)
+            arguments = {**arguments, "snapshot": snapshot}
+        return self.single_flight.do(key, handler, deadline=deadline, **arguments)
+
+    def handle_tool_calls(
+        self,
+        messages: List[Dict[str, Any]],
+        deadline: Optional[Deadline] = None,
+        snapshot: Optional[DatastoreSnapshot] = None,
+    ) -> List[Dict[str, Any]]:
         output: List[Dict[str, Any]] = []
-        # TODO: come back and clean up this logic flow. Looking at this this is
-        # pretty brittle and not as extensible as I'd like. Probably want a
-        # general abstraction over tool calls.
         for item in messages:
-            if item.type == "function_call":
-                if item.name == "get_movie_recommendation":
-                    result = self._get_movie_recommendation(
-                        **json.loads(item.arguments)
-                    )
-                    output.append(
-                        {
-                            "type": "function_call_output",
-                            "call_id": item.call_id,
-                            "output": json.dumps({"movie_recommendation": result}),
-                        }
-                    )
-                elif item.name == "get_movie_information":
-                    result = self._get_movie_information(**json.loads(item.arguments))
-                    output.append(
-                        {
-                            "type": "function_call_output",
-                            "call_id": item.call_id,
-                            "output": json.dumps({"movie_information": result}),
-                        }
-                    )
+            if item.type != "function_call" or item.name not in self.handlers:
+                continue
+            _, output_key = self.handlers[item.name]
+            result = self._call_tool(
+                item.name, json.loads(item.arguments), deadline, snapshot
+            )
+            projected = project_tool_output(item.name, output_key, result)
+            tool_output = json.dumps({output_key: projected})
+            if self.collect_output_token_stats:
+                self._record_output_tokens(
+                    item.name, json.dumps({output_key: result}), tool_output
+                )
+            output.append(
+                {
+                    "type": "function_call_output",
+                    "call_id": item.call_id,
+                    "output": tool_output,
+                }
+            )
 
         return output
@@ -1,19 +1,34 @@
-from openai import OpenAI
-from typing import List, Dict, Any
+import time
+from openai import (
+    OpenAI,
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+)
+from typing import List, Dict, Any, Optional
 from .models import CinemaExpertRequest, CinemaExpertResponse
 from .config import Config
 from .agent_tools import AgentTools
 from .prompt import SYSTEM_PROMPT
+from .deadline import Deadline, DeadlineExceeded
+from .single_flight import SingleFlight, normalize_arguments
 from structlog import get_logger
 
 logger = get_logger("app")
 
+# same retry count the openai sdk uses by default
+LLM_MAX_RETRIES = 2
+LLM_RETRY_BACKOFF_S = 0.5
+# APITimeoutError is a subclass of APIConnectionError
+RETRYABLE_LLM_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
 
 class CinemaExpert:
     def __init__(self, config: Config, openai_client: OpenAI, agent_tools: AgentTools):
         self.llm_client = openai_client
         self.tools = agent_tools
         self.config = config
+        self.single_flight = SingleFlight()
         logger.info("CinemaExpertInitalized")
 
     def _format_message(self, request: CinemaExpertRequest) -> List[Dict[str, Any]]:
@@ -23,32 +38,116 @@ class CinemaExpert:
         ]
         return messages
 
-    def invoke(self, request: CinemaExpertRequest) -> CinemaExpertResponse:
-        # TODO: would eventually like this to be llm provider agnostic. I would
-        # abtract out the llm client so you could swap between bedrock,
-        # anthropic ext.
-        initial_messages = self._format_message(request)
-        resp1 = self.llm_client.responses.create(
+    def _budget_exhausted(self, started_at: float, tokens_used: int) -> bool:
+        elapsed = time.monotonic() - started_at
+        return (
+            elapsed >= self.config.agent_time_budget_s
+            or tokens_used >= self.config.agent_token_budget
+        )
+
+    def _create_response(
+        self,
+        messages: List[Dict[str, Any]],
+        tool_choice: str,
+        deadline: Optional[Deadline],
+    ):
+        kwargs = dict(
             model=self.config.generative_model_id,
             tools=self.tools.get_tools(),
-            tool_choice=self.config.tool_choice,
-            input=initial_messages,
+            tool_choice=tool_choice,
+            input=messages,
         )
+        if deadline is None:
+            return self.llm_client.responses.create(**kwargs)
+
+        # the sdk's own retries would each get the full timeout again, so a
+        # request could run for several times its deadline. Retry here
+        # instead and give every attempt only what is left.
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            deadline.check()
+            client = self.llm_client.with_options(
+                max_retries=0, timeout=deadline.remaining()
+            )
+            try:
+                return client.responses.create(**kwargs)
+            except RETRYABLE_LLM_ERRORS as e:
+                if deadline.remaining() <= 0:
+                    # the attempt itself used up the deadline (a timeout)
+                    raise DeadlineExceeded(
+                        "LLM call ran past the request deadline"
+                    ) from e
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                backoff = LLM_RETRY_BACKOFF_S * 2**attempt
+                if deadline.remaining() <= backoff:
+                    logger.info("SkippedLLMRetry", attempt=attempt + 1, error=str(e))
+                    raise DeadlineExceeded(
+                        "Not enough time left to retry the LLM call"
+                    ) from e
+                logger.info("RetryingLLMCall", attempt=attempt + 1, error=str(e))
+                time.sleep(backoff)
+
+    def invoke(
+        self, request: CinemaExpertRequest, deadline: Optional[Deadline] = None
+    ) -> CinemaExpertResponse:
+        if self.config.coalesce_requests:
+            # identical prompts in flight at the same time share one run of the
+            # agent. Only the generated text is shared, ids stay per request.
+            key = normalize_arguments({"user_input": request.user_input})
+            generated_response = self.single_flight.do(
+                key, self._generate, request, deadline=deadline
+            )
+        else:
+            generated_response = self._generate(request, deadline=deadline)
+        return self._build_response(request, generated_response)
 
-        messages = initial_messages + resp1.output
+    def _generate(
+        self, request: CinemaExpertRequest, deadline: Optional[Deadline] = None
+    ) -> str:
+        # TODO: would eventually like this to be llm provider agnostic. I would
+        # abtract out the llm client so you could swap between bedrock,
+        # anthropic ext.
+        messages = self._format_message(request)
+        # pin the datastore version for the whole request so a snapshot swap
+        # mid-request can't mix results from two versions.
+        snapshot = self.tools.current_snapshot()
+        started_at = time.monotonic()
+        tokens_used = 0
+        # the configured tool choice only applies to the first turn. If it is
+        # "required" and we kept forcing it the loop would never terminate.
+        tool_choice = self.config.tool_choice
 
-        tool_output = self.tools.handle_tool_calls(resp1.output)
+        for step in range(self.config.max_agent_steps):
+            resp = self._create_response(messages, tool_choice, deadline)
+            if resp.usage is not None:
+                tokens_used += resp.usage.total_tokens
 
-        messages += tool_output
+            # web search is executed on openai's side, so only function calls
+            # need another round trip. No function calls means we have the
+            # final answer and can skip the extra llm call.
+            if not any(item.type == "function_call" for item in resp.output):
+                logger.info("AgentFinished", steps=step + 1, tokens_used=tokens_used)
+                return resp.output_text
 
-        resp2 = self.llm_client.responses.create(
-            model=self.config.generative_model_id,
-            tools=self.tools.get_tools(),
-            input=messages,
-        )
+            messages = messages + resp.output
+            messages += self.tools.handle_tool_calls(resp.output, deadline, snapshot)
+            tool_choice = "auto"
+
+            if self._budget_exhausted(started_at, tokens_used):
+                break
+
+        # we ran out of steps or budget while the model still wanted tools.
+        # Make one last call with tools disabled so it has to answer with
+        # what it has gathered so far.
+        logger.info("AgentBudgetExhausted", tokens_used=tokens_used)
+        resp = self._create_response(messages, "none", deadline)
+        return resp.output_text
 
+    def _build_response(
+        self, request: CinemaExpertRequest, generated_response: str
+    ) -> CinemaExpertResponse:
         return CinemaExpertResponse(
-            generated_response=resp2.output_text,
+            generated_response=generated_response,
             conversation_id=request.conversation_id,
             user_input=request.user_input,
         )
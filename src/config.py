@@ -12,6 +12,19 @@ MOVIE_SEARCH_CUTOFF_HIGH = os.getenv("MOVIE_SEARCH_MIN_BAYESIAN_AVG_HIGH")
 MOVIE_SEARCH_CUTOFF_LOW = os.getenv("MOVIE_SEARCH_MIN_BAYESIAN_AVG_LOW")
 TOOL_CHOICE = os.getenv("TOOL_CHOICE")
 DB_PATH = os.getenv("DB_PATH")
+MAX_AGENT_STEPS = os.getenv("MAX_AGENT_STEPS", 5)
+AGENT_TIME_BUDGET_S = os.getenv("AGENT_TIME_BUDGET_S", 60)
+AGENT_TOKEN_BUDGET = os.getenv("AGENT_TOKEN_BUDGET", 50000)
+BATCH_MAX_CONCURRENCY = os.getenv("BATCH_MAX_CONCURRENCY", 8)
+EMBEDDING_BATCH_SIZE = os.getenv("EMBEDDING_BATCH_SIZE", 32)
+EMBEDDING_BATCH_WAIT_MS = os.getenv("EMBEDDING_BATCH_WAIT_MS", 5)
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", False)
+MAX_IN_FLIGHT = os.getenv("MAX_IN_FLIGHT", 16)
+MAX_QUEUE = os.getenv("MAX_QUEUE", 32)
+QUEUE_TIMEOUT_S = os.getenv("QUEUE_TIMEOUT_S", 2)
+RETRY_AFTER_S = os.getenv("RETRY_AFTER_S", 1)
+REQUEST_DEADLINE_S = os.getenv("REQUEST_DEADLINE_S", 90)
+SNAPSHOT_POLL_S = os.getenv("SNAPSHOT_POLL_S", 30)
 
 
 class Config(BaseModel):
@@ -23,6 +36,19 @@ class Config(BaseModel):
     movie_search_cutoff_low: float
     tool_choice: str  # TODO: make enum
     db_path: str
+    max_agent_steps: int
+    agent_time_budget_s: float
+    agent_token_budget: int
+    batch_max_concurrency: int
+    embedding_batch_size: int
+    embedding_batch_wait_ms: float
+    coalesce_requests: bool
+    max_in_flight: int
+    max_queue: int
+    queue_timeout_s: float
+    retry_after_s: int
+    request_deadline_s: float
+    snapshot_poll_s: float
 
 
 def get_config() -> Config:
@@ -35,4 +61,17 @@ def get_config() -> Config:
         movie_search_cutoff_low=MOVIE_SEARCH_CUTOFF_LOW,
         tool_choice=TOOL_CHOICE,
         db_path=DB_PATH,
+        max_agent_steps=MAX_AGENT_STEPS,
+        agent_time_budget_s=AGENT_TIME_BUDGET_S,
+        agent_token_budget=AGENT_TOKEN_BUDGET,
+        batch_max_concurrency=BATCH_MAX_CONCURRENCY,
+        embedding_batch_size=EMBEDDING_BATCH_SIZE,
+        embedding_batch_wait_ms=EMBEDDING_BATCH_WAIT_MS,
+        coalesce_requests=COALESCE_REQUESTS,
+        max_in_flight=MAX_IN_FLIGHT,
+        max_queue=MAX_QUEUE,
+        queue_timeout_s=QUEUE_TIMEOUT_S,
+        retry_after_s=RETRY_AFTER_S,
+        request_deadline_s=REQUEST_DEADLINE_S,
+        snapshot_poll_s=SNAPSHOT_POLL_S,
     )
@@ -0,0 +1,107 @@
+# initialize_datastore.py writes every refresh to a new versioned file and
+# then flips a small pointer file next to DB_PATH to name it. The server
+# never reads a file that is being written, so a refresh doesn't need a
+# restart: a background thread notices the pointer change, opens and warms
+# the new snapshot, and only then swaps it in. Requests pin the snapshot
+# they started on, so in-flight work finishes on the old version.
+import os
+import threading
+import time
+from typing import Optional
+
+import duckdb
+from structlog import get_logger
+
+logger = get_logger("datastore")
+
+
+def pointer_path(db_path: str) -> str:
+    # must stay in sync with publish_snapshot in data/initialize_datastore.py
+    return f"{db_path}.current"
+
+
+def resolve_snapshot_path(db_path: str) -> str:
+    """The file the pointer names, or db_path itself for datastores built
+    before snapshots were versioned."""
+    pointer = pointer_path(db_path)
+    if not os.path.exists(pointer):
+        return db_path
+    with open(pointer) as f:
+        name = f.read().strip()
+    return os.path.join(os.path.dirname(pointer), name)
+
+
+class DatastoreSnapshot:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = duckdb.connect(path, read_only=True)
+
+    def warm(self):
+        # run the same kinds of queries the tools do so every page they read
+        # is in the buffer pool before the swap. Plain counts would be answered
+        # from row group statistics without reading any data.
+        with self.cursor() as conn:
+            conn.execute(
+                """
+                SELECT movieId, title
+                FROM movie
+                WHERE bayesian_avg >= 0 AND n_rating >= 0
+                ORDER BY array_cosine_similarity(embedding, ?::FLOAT[384]) DESC
+                LIMIT 10
+                """,
+                [[1.0] * 384],
+            ).fetchall()
+            conn.execute(
+                "SELECT max(jaro_winkler_similarity(search_title, 'warm up')) "
+                "FROM movie"
+            ).fetchall()
+            conn.execute("""
+                SELECT tier, max(neighborTitle), sum(similarity)
+                FROM movie_neighbors
+                GROUP BY tier
+                """).fetchall()
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        # a duckdb connection isn't safe to share between threads, a cursor
+        # per call is.
+        return self.conn.cursor()
+
+
+class SnapshotManager:
+    def __init__(self, db_path: str, poll_s: float):
+        self.db_path = db_path
+        self.poll_s = poll_s
+        self._current = self._load(resolve_snapshot_path(db_path))
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    @property
+    def current(self) -> DatastoreSnapshot:
+        return self._current
+
+    def _load(self, path: str) -> DatastoreSnapshot:
+        snapshot = DatastoreSnapshot(path)
+        snapshot.warm()
+        logger.info("LoadedSnapshot", path=path)
+        return snapshot
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_s)
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the old snapshot if the new one is unusable
+                logger.error("SnapshotRefreshFailed", error=str(e))
+
+    def refresh(self) -> Optional[DatastoreSnapshot]:
+        path = resolve_snapshot_path(self.db_path)
+        if path == self._current.path:
+            return None
+        snapshot = self._load(path)
+        # a single reference assignment, so every request sees either the old
+        # snapshot or the new one. The old connection is closed once the last
+        # request holding it lets go.
+        self._current = snapshot
+        logger.info("SwappedSnapshot", path=path)
+        return snapshot
@@ -0,0 +1,42 @@
+# every request gets a deadline when it arrives at the server. It is handed
+# down to the llm calls, the tmdb calls and the vector search so none of them
+# keeps working on a request nobody is waiting for any more. Worker threads
+# can't be killed, so cancellation is cooperative: the server cancels the
+# deadline and the work stops at its next check.
+import threading
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout_s: float):
+        self.expires_at = time.monotonic() + timeout_s
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled("The client disconnected")
+        if self.remaining() <= 0:
+            raise DeadlineExceeded("The request deadline has passed")
+
+
+def remaining_or_none(deadline: Optional[Deadline]) -> Optional[float]:
+    return deadline.remaining() if deadline is not None else None
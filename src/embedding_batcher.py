@@ -0,0 +1,77 @@
+# the sentence transformer is much cheaper per query when it encodes a
+# batch at once, and concurrent requests (the batch endpoint in particular)
+# very often embed the exact same text. This collects encode calls from
+# all request threads for a few milliseconds and runs them through the
+# model together, encoding each distinct query once.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from structlog import get_logger
+
+logger = get_logger("embedding-batcher")
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        model: SentenceTransformer,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._last_batch_shared = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def encode(self, query: str, timeout: Optional[float] = None) -> np.ndarray:
+        future: Future = Future()
+        self._queue.put((query, future))
+        return future.result(timeout=timeout)
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        # block for the first item, then, if there is concurrent traffic, give
+        # other threads one fixed window to add theirs. A single deadline stops
+        # steady traffic from stretching the window on every arrival.
+        items = [self._queue.get()]
+        if self._queue.empty() and not self._last_batch_shared:
+            # a lone query on a quiet server shouldn't pay for the window
+            return items
+        window_closes = time.monotonic() + self.max_wait_s
+        while len(items) < self.max_batch_size:
+            remaining = window_closes - time.monotonic()
+            try:
+                if remaining > 0:
+                    items.append(self._queue.get(timeout=remaining))
+                else:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            self._last_batch_shared = len(items) > 1
+            waiting: Dict[str, List[Future]] = {}
+            for query, future in items:
+                waiting.setdefault(query, []).append(future)
+            queries = list(waiting)
+            try:
+                embeddings = self.model.encode(queries)
+            except Exception as e:
+                for futures in waiting.values():
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+            for query, embedding in zip(queries, embeddings):
+                for future in waiting[query]:
+                    future.set_result(embedding)
+            logger.debug("EncodedBatch", n_requests=len(items), n_unique=len(queries))
@@ -0,0 +1,118 @@
+# tool results go straight back into the llm's context, so every field we
+# pass along costs tokens on every later turn. The raw tmdb payloads are
+# mostly things the model never uses (image paths, production companies,
+# the full crew down to the catering department). Each tool gets a
+# projection that keeps the fields worth reading and a token budget its
+# serialized output has to fit in.
+import json
+from typing import Any, Callable, Dict, List, Tuple
+
+from structlog import get_logger
+
+logger = get_logger("projection")
+
+MOVIE_INFO_FIELDS = [
+    "title",
+    "original_title",
+    "release_date",
+    "runtime",
+    "overview",
+    "tagline",
+    "budget",
+    "revenue",
+    "vote_average",
+    "vote_count",
+    "original_language",
+]
+CAST_LIMIT = 10
+CREW_LIMIT = 10
+# jobs people actually ask about, in the order they should be kept
+CREW_JOBS = [
+    "Director",
+    "Screenplay",
+    "Writer",
+    "Novel",
+    "Producer",
+    "Director of Photography",
+    "Original Music Composer",
+    "Editor",
+]
+
+TOOL_OUTPUT_TOKEN_BUDGETS = {
+    "get_movie_recommendation": 400,
+    "get_similar_movies": 400,
+    "get_movie_information": 2000,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly four characters per token for english text and json. Good
+    # enough to compare outputs against each other and against a budget.
+    return (len(text) + 3) // 4
+
+
+def project_movie(movie: Dict[str, Any]) -> Dict[str, Any]:
+    info = movie["info"]
+    credits = movie["credits"]
+    projected = {field: info.get(field) for field in MOVIE_INFO_FIELDS}
+    projected["genres"] = [genre["name"] for genre in info.get("genres", [])]
+    projected["production_countries"] = [
+        country["name"] for country in info.get("production_countries", [])
+    ]
+    cast = sorted(credits.get("cast", []), key=lambda x: x.get("order", 0))
+    projected["cast"] = [
+        {"name": member["name"], "character": member.get("character")}
+        for member in cast[:CAST_LIMIT]
+    ]
+    crew = [member for member in credits.get("crew", []) if member["job"] in CREW_JOBS]
+    crew.sort(key=lambda x: CREW_JOBS.index(x["job"]))
+    projected["crew"] = [
+        {"name": member["name"], "job": member["job"]} for member in crew[:CREW_LIMIT]
+    ]
+    return projected
+
+
+def project_movie_information(result: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [project_movie(movie) for movie in result]
+
+
+PROJECTIONS: Dict[str, Callable[[Any], Any]] = {
+    "get_movie_information": project_movie_information,
+}
+
+
+def _with_trimmable_list(result: Any) -> Tuple[Any, List[Any]]:
+    # results can be shared between coalesced callers, so copy before trimming
+    if isinstance(result, list):
+        result = list(result)
+        return result, result
+    if isinstance(result, dict):
+        keys = [key for key, value in result.items() if isinstance(value, list)]
+        if keys:
+            key = max(keys, key=lambda k: len(result[k]))
+            result = {**result, key: list(result[key])}
+            return result, result[key]
+    return result, []
+
+
+def fit_to_budget(name: str, output_key: str, result: Any) -> Any:
+    """Drop items from the end of the result's longest list until the
+    serialized output fits the tool's budget. Results are ranked, so the
+    tail is the least useful part."""
+    budget = TOOL_OUTPUT_TOKEN_BUDGETS.get(name)
+    if budget is None:
+        return result
+    result, items = _with_trimmable_list(result)
+    while estimate_tokens(json.dumps({output_key: result})) > budget:
+        if len(items) <= 1:
+            logger.warning("ToolOutputOverBudget", tool=name, budget=budget)
+            break
+        items.pop()
+    return result
+
+
+def project_tool_output(name: str, output_key: str, result: Any) -> Any:
+    projection = PROJECTIONS.get(name)
+    if projection is not None:
+        result = projection(result)
+    return fit_to_budget(name, output_key, result)
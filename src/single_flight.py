@@ -0,0 +1,90 @@
+# when a query spikes, lots of identical requests arrive at the same moment
+# and each would run the same search, hit tmdb with the same lookups or even
+# make the same llm calls. Single flight lets the first caller for a key do
+# the work while every concurrent duplicate waits on its result. Nothing is
+# cached: once the leader finishes the key is forgotten.
+import json
+import threading
+from concurrent.futures import Future, wait
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from .deadline import Deadline, DeadlineExceeded, RequestCancelled
+
+# how often a waiting follower checks its own deadline
+WAIT_SLICE_S = 0.05
+
+
+def normalize_arguments(arguments: Dict[str, Any]) -> str:
+    """Turn call arguments into a stable key so trivially different spellings
+    of the same request ("The Matrix " vs "the matrix") coalesce."""
+
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split()).casefold()
+        if isinstance(value, list):
+            return [normalize(x) for x in value]
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        return value
+
+    return json.dumps(normalize(arguments), sort_keys=True)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable[..., Any],
+        *args,
+        deadline: Optional[Deadline] = None,
+        **kwargs,
+    ) -> Any:
+        """Run fn(*args, deadline=deadline, **kwargs) unless an identical call
+        is already running, in which case wait for that one. The leader's
+        deadline governs the shared work; a follower only waits as long as its
+        own deadline allows, and if the leader ran out of time or its client
+        went away it tries again rather than failing with someone else's
+        deadline."""
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = Future()
+                    self._in_flight[key] = future
+
+            if is_leader:
+                try:
+                    result = fn(*args, deadline=deadline, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(result)
+                    return result
+                finally:
+                    with self._lock:
+                        del self._in_flight[key]
+
+            try:
+                return self._wait(future, deadline)
+            except (DeadlineExceeded, RequestCancelled):
+                # raises if it was our own deadline, otherwise the leader's
+                # ran out and we still have time to do the work ourselves.
+                if deadline is not None:
+                    deadline.check()
+
+    def _wait(self, future: Future, deadline: Optional[Deadline]) -> Any:
+        if deadline is None:
+            return future.result()
+        # wait in short slices so a follower whose client disconnects lets go
+        # of its thread straight away instead of when the leader finishes.
+        while True:
+            deadline.check()
+            done, _ = wait([future], timeout=min(WAIT_SLICE_S, deadline.remaining()))
+            if done:
+                return future.result()
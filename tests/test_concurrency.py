@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.admission import AdmissionController, AdmissionRejected
+from src.deadline import Deadline, DeadlineExceeded, RequestCancelled
+from src.single_flight import SingleFlight, normalize_arguments
+
+
+def run_in_thread(fn, *args, **kwargs):
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, outcome
+
+
+def test_deadline_check():
+    deadline = Deadline(10)
+    deadline.check()
+    assert 0 < deadline.remaining() <= 10
+
+    deadline.cancel()
+    with pytest.raises(RequestCancelled):
+        deadline.check()
+
+    with pytest.raises(DeadlineExceeded):
+        Deadline(0).check()
+
+
+def test_normalize_arguments_ignores_case_and_whitespace():
+    assert normalize_arguments({"movie": " The  Matrix"}) == normalize_arguments(
+        {"movie": "the matrix"}
+    )
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def work(deadline=None):
+        calls.append(1)
+        release.wait()
+        return "result"
+
+    leader, leader_outcome = run_in_thread(single_flight.do, "key", work)
+    time.sleep(0.05)
+    follower, follower_outcome = run_in_thread(single_flight.do, "key", work)
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(calls) == 1
+    assert leader_outcome["result"] == follower_outcome["result"] == "result"
+
+
+def test_follower_retries_when_leader_deadline_expires():
+    single_flight = SingleFlight()
+
+    def work(deadline=None):
+        time.sleep(0.2)
+        deadline.check()
+        return "result"
+
+    leader, leader_outcome = run_in_thread(
+        single_flight.do, "key", work, deadline=Deadline(0.1)
+    )
+    time.sleep(0.05)
+    follower, follower_outcome = run_in_thread(
+        single_flight.do, "key", work, deadline=Deadline(10)
+    )
+    leader.join()
+    follower.join()
+
+    assert isinstance(leader_outcome["error"], DeadlineExceeded)
+    assert follower_outcome["result"] == "result"
+
+
+def test_cancelled_follower_stops_waiting():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def work(deadline=None):
+        release.wait()
+        return "result"
+
+    leader, _ = run_in_thread(single_flight.do, "key", work, deadline=Deadline(10))
+    time.sleep(0.05)
+    follower_deadline = Deadline(10)
+    follower, follower_outcome = run_in_thread(
+        single_flight.do, "key", work, deadline=follower_deadline
+    )
+    time.sleep(0.05)
+    follower_deadline.cancel()
+    try:
+        follower.join(timeout=0.5)
+        assert not follower.is_alive()
+        assert isinstance(follower_outcome["error"], RequestCancelled)
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_admission_rejects_when_queue_is_full():
+    async def scenario():
+        admission = AdmissionController(
+            max_in_flight=1, max_queue=0, queue_timeout_s=1, retry_after_s=3
+        )
+        async with admission.admit(Deadline(10)):
+            with pytest.raises(AdmissionRejected) as e:
+                async with admission.admit(Deadline(10)):
+                    pass
+        assert e.value.retry_after == 3
+
+    asyncio.run(scenario())
+
+
+def test_admission_rejects_after_queue_timeout():
+    async def scenario():
+        admission = AdmissionController(
+            max_in_flight=1, max_queue=1, queue_timeout_s=0.05, retry_after_s=1
+        )
+        async with admission.admit(Deadline(10)):
+            with pytest.raises(AdmissionRejected):
+                async with admission.admit(Deadline(10)):
+                    pass
+
+        # the slot is free again once the first request is done
+        async with admission.admit(Deadline(10)):
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_admission_wait_for_slot_waits_past_queue_timeout():
+    async def scenario():
+        admission = AdmissionController(
+            max_in_flight=1, max_queue=0, queue_timeout_s=0.01, retry_after_s=1
+        )
+
+        async def hold_slot():
+            async with admission.admit(Deadline(10)):
+                await asyncio.sleep(0.1)
+
+        holder = asyncio.ensure_future(hold_slot())
+        await asyncio.sleep(0.01)
+        async with admission.admit(Deadline(10), wait_for_slot=True):
+            pass
+        await holder
+
+        async with admission.admit(Deadline(10)):
+            with pytest.raises(DeadlineExceeded):
+                async with admission.admit(Deadline(0.05), wait_for_slot=True):
+                    pass
+
+    asyncio.run(scenario())